@@ -0,0 +1,7 @@
+CREATE INDEX ON data.beacon_block (slot);
+
+CREATE INDEX ON data.miss (beacon_block_root);
+
+CREATE INDEX ON data.full_miss (proposer_index, block_number);
+
+DROP INDEX data.full_miss_proposer_index_idx;
@@ -1,6 +1,7 @@
 use std::{
     cmp::min,
     collections::{HashMap, HashSet},
+    fmt,
     time::{Duration, Instant},
 };
 
@@ -10,7 +11,7 @@ use thiserror::Error;
 use crate::{
     metrics,
     nonce_cache::{NonceCache, NonceCacheError},
-    pool::{ObservedTransaction, Pool},
+    pool::Pool,
     types::{Address, BeaconBlock, ExecutionPayload, Transaction, TxHash, U256},
 };
 
@@ -23,14 +24,6 @@ pub enum NonInclusionReason {
     NonceMismatch,
 }
 
-#[derive(Debug, Error)]
-enum InclusionCheckError {
-    #[error("cannot check inclusion as transaction is missing required field")]
-    TransactionError(#[from] TransactionError),
-    #[error("cannot check inclusion due to nonce cache error")]
-    NonceCacheError(#[from] NonceCacheError),
-}
-
 #[derive(Debug, Error)]
 pub enum TransactionError {
     #[error("transaction is missing required field {name}")]
@@ -45,23 +38,44 @@ pub enum TransactionError {
     },
 }
 
-/// Perform all inclusion checks.
-async fn check_inclusion(
+/// Outcome of the inclusion checks for a single transaction.
+#[derive(Debug)]
+enum InclusionCheck {
+    /// The transaction was not included for a justified reason.
+    Justified(NonInclusionReason),
+    /// There is no justified reason for the non-inclusion. The tip the
+    /// transaction would have paid is attached.
+    Unjustified { tip: U256 },
+}
+
+/// Perform all inclusion checks except for the nonce check. The latter is done
+/// separately in a second pass, so that the nonces of all remaining candidates
+/// can be fetched at once. The unused gas and the median tip of the block are
+/// passed in so that they only have to be computed once per block, not once per
+/// transaction. The tip of the transaction is computed only once and serves
+/// both the base fee and the tip check.
+fn check_inclusion(
     transaction: &Transaction,
-    beacon_block: &BeaconBlock<Transaction>,
-    nonce_cache: &mut NonceCache,
-) -> Result<Option<NonInclusionReason>, InclusionCheckError> {
-    let exec = &beacon_block.body.execution_payload;
-    if check_not_enough_space(transaction, exec) {
-        Ok(Some(NonInclusionReason::NotEnoughSpace))
-    } else if check_base_fee_too_low(transaction, exec)? {
-        Ok(Some(NonInclusionReason::BaseFeeTooLow))
-    } else if check_tip_too_low(transaction, exec)? {
-        Ok(Some(NonInclusionReason::TipTooLow))
-    } else if check_nonce_mismatch(transaction, beacon_block, nonce_cache).await? {
-        Ok(Some(NonInclusionReason::NonceMismatch))
+    exec: &ExecutionPayload<Transaction>,
+    unused_gas: U256,
+    median_tip: U256,
+) -> Result<InclusionCheck, TransactionError> {
+    if transaction.gas > unused_gas {
+        return Ok(InclusionCheck::Justified(
+            NonInclusionReason::NotEnoughSpace,
+        ));
+    }
+    let tip = match get_tip(transaction, exec.base_fee_per_gas) {
+        Ok(tip) => tip,
+        Err(TransactionError::FeeTooLow { .. }) => {
+            return Ok(InclusionCheck::Justified(NonInclusionReason::BaseFeeTooLow))
+        }
+        Err(e) => return Err(e),
+    };
+    if tip < median_tip {
+        Ok(InclusionCheck::Justified(NonInclusionReason::TipTooLow))
     } else {
-        Ok(None)
+        Ok(InclusionCheck::Unjustified { tip })
     }
 }
 
@@ -75,51 +89,47 @@ fn get_transaction_type(transaction: &Transaction) -> Result<u64, TransactionErr
     }
 }
 
+/// Get the maximum fee per gas, i.e., base fee plus tip, the transaction of the
+/// given type is willing to pay.
+fn get_max_fee(transaction: &Transaction, transaction_type: u64) -> Result<U256, TransactionError> {
+    match transaction_type {
+        0 | 1 => transaction
+            .gas_price
+            .ok_or_else(|| TransactionError::MissingRequiredField {
+                name: String::from("gasPrice"),
+            }),
+        2 => transaction
+            .max_fee_per_gas
+            .ok_or_else(|| TransactionError::MissingRequiredField {
+                name: String::from("maxFeePerGas"),
+            }),
+        _ => Err(TransactionError::UnsupportedType { transaction_type }),
+    }
+}
+
 /// Calculate the tip amount a transaction would pay in a block with given base
 /// fee.
 pub fn get_tip(transaction: &Transaction, base_fee: U256) -> Result<U256, TransactionError> {
     let t = get_transaction_type(transaction)?;
-    if t == 0 || t == 1 {
-        let gas_price = transaction
-            .gas_price
-            .ok_or(TransactionError::MissingRequiredField {
-                name: String::from("gasPrice"),
-            })?;
-        if gas_price < base_fee {
-            Err(TransactionError::FeeTooLow {
-                max_fee: gas_price,
-                base_fee,
-                transaction_type: t,
-            })
-        } else {
-            Ok(gas_price - base_fee)
-        }
-    } else if t == 2 {
-        let max_fee_per_gas =
-            transaction
-                .max_fee_per_gas
-                .ok_or(TransactionError::MissingRequiredField {
-                    name: String::from("maxFeePerGas"),
-                })?;
-        let max_priority_fee_per_gas =
-            transaction
-                .max_priority_fee_per_gas
-                .ok_or(TransactionError::MissingRequiredField {
-                    name: String::from("maxPriorityFeePerGas"),
+    let max_fee = get_max_fee(transaction, t)?;
+    if max_fee < base_fee {
+        return Err(TransactionError::FeeTooLow {
+            max_fee,
+            base_fee,
+            transaction_type: t,
+        });
+    }
+    match t {
+        2 => {
+            let max_priority_fee_per_gas =
+                transaction.max_priority_fee_per_gas.ok_or_else(|| {
+                    TransactionError::MissingRequiredField {
+                        name: String::from("maxPriorityFeePerGas"),
+                    }
                 })?;
-        if max_fee_per_gas < base_fee {
-            Err(TransactionError::FeeTooLow {
-                max_fee: max_fee_per_gas,
-                base_fee,
-                transaction_type: t,
-            })
-        } else {
-            Ok(min(max_fee_per_gas - base_fee, max_priority_fee_per_gas))
+            Ok(min(max_fee - base_fee, max_priority_fee_per_gas))
         }
-    } else {
-        Err(TransactionError::UnsupportedType {
-            transaction_type: t,
-        })
+        _ => Ok(max_fee - base_fee),
     }
 }
 
@@ -129,8 +139,13 @@ pub fn check_not_enough_space(
     transaction: &Transaction,
     exec: &ExecutionPayload<Transaction>,
 ) -> bool {
+    transaction.gas > get_unused_gas(exec)
+}
+
+/// Get the amount of gas left unused in the block.
+fn get_unused_gas(exec: &ExecutionPayload<Transaction>) -> U256 {
     let unused_gas = exec.gas_limit - exec.gas_used;
-    transaction.gas > U256::from(unused_gas.as_u64())
+    U256::from(unused_gas.as_u64())
 }
 
 /// Check if the transaction doesn't pay a high enough base fee.
@@ -139,23 +154,7 @@ pub fn check_base_fee_too_low(
     exec: &ExecutionPayload<Transaction>,
 ) -> Result<bool, TransactionError> {
     let t = get_transaction_type(transaction)?;
-    let max_base_fee = if t == 0 || t == 1 {
-        transaction
-            .gas_price
-            .ok_or(TransactionError::MissingRequiredField {
-                name: String::from("gasPrice"),
-            })?
-    } else if t == 2 {
-        transaction
-            .max_fee_per_gas
-            .ok_or(TransactionError::MissingRequiredField {
-                name: String::from("maxFeePerGas"),
-            })?
-    } else {
-        return Err(TransactionError::UnsupportedType {
-            transaction_type: t,
-        });
-    };
+    let max_base_fee = get_max_fee(transaction, t)?;
     Ok(max_base_fee < exec.base_fee_per_gas)
 }
 
@@ -224,7 +223,7 @@ pub struct Analysis {
     pub beacon_block: BeaconBlock<Transaction>,
     pub quorum: usize,
     pub missing_transactions: HashMap<TxHash, MissedTransaction>,
-    pub included_transactions: HashMap<TxHash, ObservedTransaction>,
+    pub included_transactions: HashSet<TxHash>,
     pub num_txs_in_block: usize,
     pub num_txs_in_pool: usize,
     pub num_quorum_not_reached: usize,
@@ -243,9 +242,12 @@ pub struct MissedTransaction {
     pub tip: i64,
 }
 
-impl Analysis {
-    pub fn summary(&self) -> String {
-        format!(
+/// The summary of an analysis. Implemented as Display so that it is only
+/// formatted if it is actually logged.
+impl fmt::Display for Analysis {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> Result<(), fmt::Error> {
+        write!(
+            f,
             "Analysis for block {beacon_block}: {included} txs from pool included, {missing} \
              missed, {in_pool} in pool, {in_block} in block, {quorum_not_reached} quorum not \
              reached, {only_hash} only hash known, {replaced} replaced, {nonce_mismatch} nonce \
@@ -293,22 +295,27 @@ pub async fn analyze(
         HashSet::from_iter(exec.transactions.iter().map(|tx| &tx.hash));
     let senders_in_block: HashSet<&Address> =
         HashSet::from_iter(exec.transactions.iter().map(|tx| &tx.from));
+    let unused_gas = get_unused_gas(exec);
+    let median_tip = get_median_tip(&exec.transactions, exec.base_fee_per_gas);
     let proposal_time = beacon_block.proposal_time();
     let pool_at_t = pool.content_at(proposal_time);
 
     let num_txs_in_block = exec.transactions.len();
-    let num_txs_in_pool = pool_at_t.len();
+    let mut num_txs_in_pool = 0;
 
-    let mut included_txs = HashMap::new();
+    let mut included_txs = HashSet::new();
     let mut num_only_tx_hash = 0;
     let mut num_quorum_not_reached = 0;
     let mut num_replaced_txs = 0;
     let mut missing_txs = HashMap::new();
     let mut non_inclusion_reasons = HashMap::new();
+    let mut candidates = Vec::new();
 
-    for (hash, obs_tx) in pool_at_t {
+    for obs_tx in pool_at_t {
+        num_txs_in_pool += 1;
+        let hash = obs_tx.hash;
         if txs_in_block.contains(&hash) {
-            included_txs.insert(hash, obs_tx);
+            included_txs.insert(hash);
             continue;
         }
         if obs_tx.num_nodes_seen(proposal_time) < quorum {
@@ -319,50 +326,18 @@ pub async fn analyze(
             num_only_tx_hash += 1;
             continue;
         }
-        let tx = obs_tx.transaction.as_ref().unwrap();
+        let tx = obs_tx.transaction.as_deref().unwrap();
         if senders_in_block.contains(&tx.from) {
             num_replaced_txs += 1;
             continue;
         }
 
-        match check_inclusion(tx, beacon_block, nonce_cache).await {
-            Ok(Some(reason)) => *non_inclusion_reasons.entry(reason).or_insert(0) += 1,
-            Ok(None) => {
-                if obs_tx.transaction.is_none() {
-                    log::error!("transaction without body failed inclusion checks");
-                    continue;
-                }
-                let first_seen = obs_tx.quorum_reached_timestamp(1);
-                let quorum_reached = obs_tx.quorum_reached_timestamp(quorum);
-                if first_seen.is_none() || quorum_reached.is_none() {
-                    log::error!("transaction without quorum failed inclusion checks");
-                    continue;
-                }
-                let tx = obs_tx.transaction.unwrap();
-                let tip = get_tip(&tx, beacon_block.body.execution_payload.base_fee_per_gas);
-                if let Err(e) = tip {
-                    log::error!(
-                        "transaction whose tip we cannot determine failed inclusion checks ({})",
-                        e
-                    );
-                    continue;
-                }
-                let tip = tip.unwrap();
-                if tip > U256::from(i64::MAX) {
-                    log::warn!("ignoring tx with huge tip");
-                    continue;
-                }
-                let tip = tip.as_u64() as i64;
-                let missed_tx = MissedTransaction {
-                    hash: obs_tx.hash,
-                    transaction: tx,
-                    first_seen: first_seen.unwrap(),
-                    quorum_reached: quorum_reached.unwrap(),
-                    tip,
-                };
-                missing_txs.insert(hash, missed_tx);
+        match check_inclusion(tx, exec, unused_gas, median_tip) {
+            Ok(InclusionCheck::Justified(reason)) => {
+                *non_inclusion_reasons.entry(reason).or_insert(0) += 1
             }
-            Err(InclusionCheckError::TransactionError(e)) => {
+            Ok(InclusionCheck::Unjustified { tip }) => candidates.push((obs_tx, tx, tip)),
+            Err(e) => {
                 log::warn!(
                     "failed to check inclusion criteria for tx {}: {} (tx: {:?})",
                     tx.hash,
@@ -370,12 +345,44 @@ pub async fn analyze(
                     tx,
                 )
             }
-            Err(InclusionCheckError::NonceCacheError(e)) => {
-                return Err(e);
-            }
         }
     }
 
+    // fetch the nonces of all remaining candidates concurrently instead of one
+    // after the other in the loop below
+    nonce_cache
+        .prefetch(candidates.iter().map(|(_, tx, _)| tx.from), beacon_block)
+        .await?;
+
+    for (obs_tx, tx, tip) in candidates {
+        if check_nonce_mismatch(tx, beacon_block, nonce_cache).await? {
+            *non_inclusion_reasons
+                .entry(NonInclusionReason::NonceMismatch)
+                .or_insert(0) += 1;
+            continue;
+        }
+
+        let first_seen = obs_tx.quorum_reached_timestamp(1);
+        let quorum_reached = obs_tx.quorum_reached_timestamp(quorum);
+        if first_seen.is_none() || quorum_reached.is_none() {
+            log::error!("transaction without quorum failed inclusion checks");
+            continue;
+        }
+        if tip > U256::from(i64::MAX) {
+            log::warn!("ignoring tx with huge tip");
+            continue;
+        }
+        let tip = tip.as_u64() as i64;
+        let missed_tx = MissedTransaction {
+            hash: obs_tx.hash,
+            transaction: tx.clone(),
+            first_seen: first_seen.unwrap(),
+            quorum_reached: quorum_reached.unwrap(),
+            tip,
+        };
+        missing_txs.insert(obs_tx.hash, missed_tx);
+    }
+
     let duration = start_time.elapsed();
     metrics::ANALYSIS_DURATION.set(duration.as_millis() as f64 / 1000.);
     metrics::TRANSACTIONS_IN_BLOCKS.inc_by(txs_in_block.len() as u64);
@@ -420,3 +427,160 @@ pub async fn analyze(
         duration,
     })
 }
+
+#[cfg(test)]
+mod test {
+    use super::*;
+    use crate::types::U64;
+
+    const BASE_FEE: u64 = 10;
+
+    fn legacy_tx(gas_price: u64, gas: u64) -> Transaction {
+        Transaction {
+            transaction_type: Some(U64::from(0)),
+            gas_price: Some(U256::from(gas_price)),
+            gas: U256::from(gas),
+            ..Transaction::default()
+        }
+    }
+
+    fn eip1559_tx(max_fee: u64, max_priority_fee: u64, gas: u64) -> Transaction {
+        Transaction {
+            transaction_type: Some(U64::from(2)),
+            max_fee_per_gas: Some(U256::from(max_fee)),
+            max_priority_fee_per_gas: Some(U256::from(max_priority_fee)),
+            gas: U256::from(gas),
+            ..Transaction::default()
+        }
+    }
+
+    /// Block with 30000 unused gas whose transactions pay tips of 2, 4, and 6,
+    /// so the median tip is 4.
+    fn make_exec() -> ExecutionPayload<Transaction> {
+        ExecutionPayload {
+            gas_limit: U64::from(100_000),
+            gas_used: U64::from(70_000),
+            base_fee_per_gas: U256::from(BASE_FEE),
+            transactions: vec![
+                legacy_tx(12, 21_000),
+                eip1559_tx(20, 4, 21_000),
+                legacy_tx(16, 21_000),
+            ],
+            ..ExecutionPayload::default()
+        }
+    }
+
+    fn check(
+        transaction: &Transaction,
+        exec: &ExecutionPayload<Transaction>,
+    ) -> Result<InclusionCheck, TransactionError> {
+        check_inclusion(
+            transaction,
+            exec,
+            get_unused_gas(exec),
+            get_median_tip(&exec.transactions, exec.base_fee_per_gas),
+        )
+    }
+
+    /// Check that the individual checks used by check_transaction come to the
+    /// same conclusion as check_inclusion, applying them in the same order.
+    fn assert_agrees_with_individual_checks(
+        transaction: &Transaction,
+        exec: &ExecutionPayload<Transaction>,
+    ) {
+        let expected = if check_not_enough_space(transaction, exec) {
+            Some(NonInclusionReason::NotEnoughSpace)
+        } else if check_base_fee_too_low(transaction, exec).unwrap() {
+            Some(NonInclusionReason::BaseFeeTooLow)
+        } else if check_tip_too_low(transaction, exec).unwrap() {
+            Some(NonInclusionReason::TipTooLow)
+        } else {
+            None
+        };
+        match check(transaction, exec).unwrap() {
+            InclusionCheck::Justified(reason) => assert_eq!(Some(reason), expected),
+            InclusionCheck::Unjustified { .. } => assert_eq!(None, expected),
+        }
+    }
+
+    fn assert_justified(transaction: Transaction, reason: NonInclusionReason) {
+        let exec = make_exec();
+        match check(&transaction, &exec).unwrap() {
+            InclusionCheck::Justified(r) => assert_eq!(r, reason),
+            c => panic!("expected {:?}, got {:?}", reason, c),
+        }
+        assert_agrees_with_individual_checks(&transaction, &exec);
+    }
+
+    fn assert_unjustified(transaction: Transaction, expected_tip: u64) {
+        let exec = make_exec();
+        match check(&transaction, &exec).unwrap() {
+            InclusionCheck::Unjustified { tip } => assert_eq!(tip, U256::from(expected_tip)),
+            c => panic!("expected unjustified, got {:?}", c),
+        }
+        assert_agrees_with_individual_checks(&transaction, &exec);
+    }
+
+    #[test]
+    fn test_median_tip() {
+        let exec = make_exec();
+        assert_eq!(
+            get_median_tip(&exec.transactions, exec.base_fee_per_gas),
+            U256::from(4)
+        );
+        assert_eq!(get_unused_gas(&exec), U256::from(30_000));
+    }
+
+    #[test]
+    fn test_not_enough_space() {
+        assert_justified(legacy_tx(100, 30_001), NonInclusionReason::NotEnoughSpace);
+        assert_justified(
+            eip1559_tx(100, 50, 30_001),
+            NonInclusionReason::NotEnoughSpace,
+        );
+        // space is checked before fees
+        assert_justified(legacy_tx(1, 30_001), NonInclusionReason::NotEnoughSpace);
+        assert_unjustified(legacy_tx(100, 30_000), 90);
+    }
+
+    #[test]
+    fn test_base_fee_too_low() {
+        assert_justified(legacy_tx(9, 21_000), NonInclusionReason::BaseFeeTooLow);
+        assert_justified(eip1559_tx(9, 5, 21_000), NonInclusionReason::BaseFeeTooLow);
+    }
+
+    #[test]
+    fn test_tip_too_low() {
+        assert_justified(legacy_tx(13, 21_000), NonInclusionReason::TipTooLow);
+        assert_justified(eip1559_tx(100, 3, 21_000), NonInclusionReason::TipTooLow);
+        // the tip is capped by the max fee even if the priority fee is high
+        assert_justified(eip1559_tx(13, 100, 21_000), NonInclusionReason::TipTooLow);
+        // paying exactly the base fee is a zero tip
+        assert_justified(legacy_tx(10, 21_000), NonInclusionReason::TipTooLow);
+    }
+
+    #[test]
+    fn test_unjustified() {
+        assert_unjustified(legacy_tx(15, 21_000), 5);
+        // a tip equal to the median is high enough
+        assert_unjustified(legacy_tx(14, 21_000), 4);
+        // the tip of a type 2 transaction is limited by its priority fee
+        assert_unjustified(eip1559_tx(100, 5, 21_000), 5);
+        // ...and by the max fee minus the base fee
+        assert_unjustified(eip1559_tx(15, 100, 21_000), 5);
+    }
+
+    #[test]
+    fn test_unsupported_type() {
+        let transaction = Transaction {
+            transaction_type: Some(U64::from(3)),
+            ..legacy_tx(100, 21_000)
+        };
+        assert!(matches!(
+            check(&transaction, &make_exec()),
+            Err(TransactionError::UnsupportedType {
+                transaction_type: 3
+            })
+        ));
+    }
+}
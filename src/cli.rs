@@ -57,7 +57,13 @@ pub struct Config {
     pub db_enabled: bool,
     #[serde(default)]
     pub db_connection: String,
+    #[serde(default = "default_db_max_connections")]
+    pub db_max_connections: u32,
+    #[serde(default = "default_db_synchronous_commit")]
+    pub db_synchronous_commit: bool,
 
+    #[serde(default = "default_metrics_enabled")]
+    pub metrics_enabled: bool,
     #[serde(default = "default_metrics_endpoint")]
     pub metrics_endpoint: SocketAddr,
 
@@ -92,6 +98,18 @@ fn default_sync_check_enabled() -> bool {
     true
 }
 
+fn default_db_max_connections() -> u32 {
+    5
+}
+
+fn default_db_synchronous_commit() -> bool {
+    true
+}
+
+fn default_metrics_enabled() -> bool {
+    true
+}
+
 fn default_metrics_endpoint() -> SocketAddr {
     SocketAddr::new(IpAddr::V4(Ipv4Addr::new(127, 0, 0, 1)), 8080)
 }
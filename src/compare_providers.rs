@@ -1,5 +1,5 @@
 use std::{
-    collections::HashSet,
+    collections::HashMap,
     io::{stdout, Write},
 };
 
@@ -12,7 +12,7 @@ use tokio::sync::{
 
 use crate::{
     cli,
-    types::TxHash,
+    types::{NodeKey, TxHash},
     watch::{watch_transactions, Event, NodeConfig},
 };
 
@@ -55,10 +55,8 @@ pub async fn compare_providers(config: &cli::Config) -> Result<()> {
 }
 
 async fn process_transactions(rx: &mut Receiver<Event>, n: usize) -> Result<()> {
-    let mut seen_by: Vec<HashSet<TxHash>> = Vec::new();
-    for _ in 0..n {
-        seen_by.push(HashSet::new());
-    }
+    let mut overlaps = Overlaps::new(n);
+
     let mut i = 0;
     while let Some(event) = rx.recv().await {
         match event {
@@ -66,9 +64,7 @@ async fn process_transactions(rx: &mut Receiver<Event>, n: usize) -> Result<()>
                 node,
                 hash,
                 timestamp: _,
-            } => {
-                seen_by[node].insert(hash);
-            }
+            } => overlaps.observe(node, hash),
             _ => {
                 return Err(eyre!("received non-transaction event"));
             }
@@ -77,20 +73,16 @@ async fn process_transactions(rx: &mut Receiver<Event>, n: usize) -> Result<()>
         i += 1;
         if i % 10 == 0 {
             print!("\r");
-            for k in 1..(n + 1) {
-                for combination in (0..n).combinations(k) {
-                    let mut union = seen_by[combination[0]].clone();
-                    let mut intersection = seen_by[combination[0]].clone();
-                    for j in &combination[1..] {
-                        union.extend(&seen_by[*j]);
-                        intersection.retain(|e| seen_by[*j].contains(e));
-                    }
-                    print!(
-                        "{:>8} {:.2}",
-                        intersection.len(),
-                        (intersection.len() as f64) / (union.len() as f64),
-                    );
-                }
+            for (intersection_size, union_size) in overlaps
+                .intersection_sizes
+                .iter()
+                .zip(&overlaps.union_sizes)
+            {
+                print!(
+                    "{:>8} {:.2}",
+                    intersection_size,
+                    (*intersection_size as f64) / (*union_size as f64),
+                );
             }
             stdout().flush().unwrap();
         }
@@ -98,3 +90,105 @@ async fn process_transactions(rx: &mut Receiver<Event>, n: usize) -> Result<()>
 
     Ok(())
 }
+
+/// Overlaps tracks the sizes of the intersections and unions of the sets of
+/// transactions seen by each combination of nodes.
+///
+/// Instead of recomputing intersections and unions of the per-node hash sets on
+/// every update, the set of nodes that have seen each transaction is stored as
+/// a bit mask and the sizes of all node combinations are updated incrementally.
+/// Combinations are ordered by size first and then lexicographically.
+struct Overlaps {
+    combinations: Vec<u64>,
+    seen_by: HashMap<TxHash, u64>,
+    intersection_sizes: Vec<usize>,
+    union_sizes: Vec<usize>,
+}
+
+impl Overlaps {
+    fn new(n: usize) -> Self {
+        let combinations: Vec<u64> = (1..(n + 1))
+            .flat_map(|k| (0..n).combinations(k))
+            .map(|combination| combination.iter().fold(0, |mask, j| mask | 1 << j))
+            .collect();
+        let num_combinations = combinations.len();
+        Overlaps {
+            combinations,
+            seen_by: HashMap::new(),
+            intersection_sizes: vec![0; num_combinations],
+            union_sizes: vec![0; num_combinations],
+        }
+    }
+
+    /// Record that the given node has seen the transaction with the given hash.
+    fn observe(&mut self, node: NodeKey, hash: TxHash) {
+        let mask = self.seen_by.entry(hash).or_insert(0);
+        let before = *mask;
+        let after = before | 1 << node;
+        *mask = after;
+        for (j, &combination) in self.combinations.iter().enumerate() {
+            if before & combination != combination && after & combination == combination {
+                self.intersection_sizes[j] += 1;
+            }
+            if before & combination == 0 && after & combination != 0 {
+                self.union_sizes[j] += 1;
+            }
+        }
+    }
+}
+
+#[cfg(test)]
+mod test {
+    use std::collections::HashSet;
+
+    use super::*;
+
+    #[test]
+    fn test_overlaps_match_naive_sets() {
+        let n = 3;
+        let events = [
+            (0, 1),
+            (1, 1),
+            (0, 2),
+            (2, 3),
+            (0, 1),
+            (1, 3),
+            (2, 1),
+            (1, 4),
+            (2, 2),
+            (0, 3),
+        ];
+
+        let combinations: Vec<Vec<NodeKey>> =
+            (1..(n + 1)).flat_map(|k| (0..n).combinations(k)).collect();
+        let mut overlaps = Overlaps::new(n);
+        let mut seen: Vec<HashSet<TxHash>> = vec![HashSet::new(); n];
+        for (node, i) in events {
+            let hash = TxHash::from_low_u64_be(i);
+            overlaps.observe(node, hash);
+            seen[node].insert(hash);
+
+            for (j, combination) in combinations.iter().enumerate() {
+                let sets = combination.iter().map(|&node| &seen[node]);
+                let intersection = sets
+                    .clone()
+                    .map(|s| s.clone())
+                    .reduce(|a, b| &a & &b)
+                    .unwrap();
+                let union = sets.map(|s| s.clone()).reduce(|a, b| &a | &b).unwrap();
+                assert_eq!(
+                    overlaps.intersection_sizes[j],
+                    intersection.len(),
+                    "intersection of {:?}",
+                    combination
+                );
+                assert_eq!(
+                    overlaps.union_sizes[j],
+                    union.len(),
+                    "union of {:?}",
+                    combination
+                );
+            }
+        }
+    }
+}
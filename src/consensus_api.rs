@@ -1,3 +1,5 @@
+use std::time::Duration;
+
 use ethers::utils::keccak256;
 use rlp::Decodable;
 use serde::Deserialize;
@@ -5,9 +7,14 @@ use thiserror::Error;
 use url::Url;
 
 use crate::types::{
-    url_with_path, BeaconBlockWithoutRoot, ConsensusSyncStatus, SignedMessage, Transaction, H256,
+    url_with_path, BeaconBlockWithoutRoot, Bytes, ConsensusSyncStatus, SignedMessage, Transaction,
+    H256,
 };
 
+const BEACON_BLOCKS_PATH: &str = "/eth/v2/beacon/blocks";
+const SYNC_STATUS_PATH: &str = "/eth/v1/node/syncing";
+const REQUEST_TIMEOUT: Duration = Duration::from_secs(30);
+
 #[derive(Error, Debug)]
 pub enum ConsensusAPIError {
     #[error("error fetching {requested}")]
@@ -17,6 +24,8 @@ pub enum ConsensusAPIError {
     },
     #[error("unexpected node response: {description}")]
     UnexpectedResponse { description: String },
+    #[error("error joining decoding task")]
+    Join(#[from] tokio::task::JoinError),
 }
 
 #[derive(Deserialize, Debug, PartialEq, Eq, Clone)]
@@ -25,14 +34,29 @@ pub struct ConsensusAPIResponse<T> {
     pub execution_optimistic: Option<bool>,
 }
 
+/// ConsensusProvider fetches data from the API of a consensus node. The
+/// endpoint URLs are built once on construction. All requests go through the
+/// same client so that connections to the node are kept alive and reused.
 #[derive(Debug)]
 pub struct ConsensusProvider {
-    http_url: Url,
+    client: reqwest::Client,
+    beacon_blocks_url: Url,
+    sync_status_url: Url,
 }
 
 impl ConsensusProvider {
     pub fn new(http_url: Url) -> Self {
-        ConsensusProvider { http_url }
+        // building the client only fails if the TLS backend cannot be initialized,
+        // in which case we cannot do anything useful anyway
+        let client = reqwest::Client::builder()
+            .timeout(REQUEST_TIMEOUT)
+            .build()
+            .unwrap();
+        ConsensusProvider {
+            client,
+            beacon_blocks_url: url_with_path(&http_url, BEACON_BLOCKS_PATH),
+            sync_status_url: url_with_path(&http_url, SYNC_STATUS_PATH),
+        }
     }
 
     pub async fn fetch_beacon_block_by_root(
@@ -55,12 +79,12 @@ impl ConsensusProvider {
         &self,
         path: String,
     ) -> Result<BeaconBlockWithoutRoot<Transaction>, ConsensusAPIError> {
-        let url = url_with_path(
-            &self.http_url,
-            format!("/eth/v2/beacon/blocks/{}", path).as_str(),
-        );
+        let url = url_with_path(&self.beacon_blocks_url, path.as_str());
 
-        let r = reqwest::get(url)
+        let r = self
+            .client
+            .get(url)
+            .send()
             .await
             .map_err(|e| ConsensusAPIError::ReqwestError {
                 source: e,
@@ -71,7 +95,7 @@ impl ConsensusProvider {
                 source: e,
                 requested: String::from("beacon block"),
             })?;
-        let response: ConsensusAPIResponse<SignedMessage<BeaconBlockWithoutRoot<String>>> = r
+        let response: ConsensusAPIResponse<SignedMessage<BeaconBlockWithoutRoot<Bytes>>> = r
             .json()
             .await
             .map_err(|e| ConsensusAPIError::ReqwestError {
@@ -85,36 +109,17 @@ impl ConsensusProvider {
             });
         }
 
-        let tx_strings = &response.data.message.body.execution_payload.transactions;
-        let mut txs = Vec::new();
-        for s in tx_strings {
-            let b = hex::decode(s.strip_prefix("0x").unwrap_or(s.as_str())).map_err(|e| {
-                ConsensusAPIError::UnexpectedResponse {
-                    description: format!("error decoding tx in block: {}", e),
-                }
-            })?;
-            let tx = Transaction::decode(&rlp::Rlp::new(b.as_slice()));
-            match tx {
-                Err(e) => log::warn!(
-                    "received block {} with undecodable tx 0x{}: {}",
-                    response.data.message,
-                    hex::encode(keccak256(b)),
-                    e,
-                ),
-                Ok(mut tx) => {
-                    // set tx hash manually (see https://github.com/gakonst/ethers-rs/issues/1849)
-                    tx.hash = H256::from(keccak256(b));
-                    txs.push(tx);
-                }
-            }
-        }
-        let beacon_block = BeaconBlockWithoutRoot::with_transactions(response.data.message, txs);
-        Ok(beacon_block)
+        // decoding the transactions includes recovering their senders which is CPU
+        // bound, so we do it on the blocking thread pool to not stall the other
+        // tasks
+        tokio::task::spawn_blocking(move || decode_transactions(response.data.message)).await?
     }
 
     pub async fn fetch_sync_status(&self) -> Result<ConsensusSyncStatus, ConsensusAPIError> {
-        let url = url_with_path(&self.http_url, "/eth/v1/node/syncing");
-        let r = reqwest::get(url)
+        let r = self
+            .client
+            .get(self.sync_status_url.clone())
+            .send()
             .await
             .map_err(|e| ConsensusAPIError::ReqwestError {
                 source: e,
@@ -135,3 +140,31 @@ impl ConsensusProvider {
         Ok(response.data)
     }
 }
+
+/// Decode the RLP encoded transactions of a beacon block. The transactions are
+/// deserialized from hex straight into bytes, so only the RLP decoding is left
+/// to do here.
+fn decode_transactions(
+    beacon_block: BeaconBlockWithoutRoot<Bytes>,
+) -> Result<BeaconBlockWithoutRoot<Transaction>, ConsensusAPIError> {
+    let tx_bytes = &beacon_block.body.execution_payload.transactions;
+    let mut txs = Vec::with_capacity(tx_bytes.len());
+    for b in tx_bytes {
+        let hash = H256::from(keccak256(b));
+        let tx = Transaction::decode(&rlp::Rlp::new(b));
+        match tx {
+            Err(e) => log::warn!(
+                "received block {} with undecodable tx 0x{}: {}",
+                beacon_block,
+                hex::encode(hash),
+                e,
+            ),
+            Ok(mut tx) => {
+                // set tx hash manually (see https://github.com/gakonst/ethers-rs/issues/1849)
+                tx.hash = hash;
+                txs.push(tx);
+            }
+        }
+    }
+    Ok(BeaconBlockWithoutRoot::with_transactions(beacon_block, txs))
+}
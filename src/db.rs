@@ -1,14 +1,44 @@
-use hex::ToHex;
+use chrono::NaiveDateTime;
+use sqlx::{
+    postgres::{PgConnectOptions, PgPoolOptions},
+    ConnectOptions,
+};
 
 use crate::analyze::Analysis;
 
 type Pool = sqlx::Pool<sqlx::Postgres>;
 
-pub async fn connect(s: &str) -> Result<Pool, sqlx::Error> {
-    log::debug!("connecting to db at {}", s);
-    sqlx::postgres::PgPoolOptions::new()
-        .max_connections(5)
-        .connect(s)
+/// Connect to the database. If synchronous_commit is false, commits do not wait
+/// for their WAL records to be flushed to disk. This lowers commit latency at
+/// the risk of losing the most recent transactions, but not of corrupting the
+/// database, if the server crashes.
+pub async fn connect(
+    s: &str,
+    max_connections: u32,
+    synchronous_commit: bool,
+) -> Result<Pool, sqlx::Error> {
+    log::debug!(
+        "connecting to db at {} with up to {} connections",
+        s,
+        max_connections
+    );
+    // we don't rely on sqlx's per-statement logs, so turn them off instead of
+    // running every statement through the query logger
+    let mut options: PgConnectOptions = s.parse()?;
+    options.disable_statement_logging();
+    PgPoolOptions::new()
+        .max_connections(max_connections)
+        .after_connect(move |conn, _| {
+            Box::pin(async move {
+                if !synchronous_commit {
+                    sqlx::query("SET synchronous_commit = off")
+                        .execute(conn)
+                        .await?;
+                }
+                Ok(())
+            })
+        })
+        .connect_with(options)
         .await
 }
 
@@ -28,13 +58,36 @@ pub async fn truncate(pool: &Pool) -> Result<(), sqlx::Error> {
     Ok(())
 }
 
-pub async fn insert_analysis_into_db(analysis: &Analysis, pool: &Pool) -> Result<(), sqlx::Error> {
+/// Persist the given analyses in a single database transaction, so that
+/// analyses that queue up only cost one commit.
+pub async fn insert_analyses_into_db(
+    analyses: &[Analysis],
+    pool: &Pool,
+) -> Result<(), sqlx::Error> {
+    let mut tx = pool.begin().await?;
+    for analysis in analyses {
+        insert_analysis(analysis, &mut tx).await?;
+    }
+    tx.commit().await?;
+    log::debug!("persisted {} analyses in db", analyses.len());
+    Ok(())
+}
+
+async fn insert_analysis(
+    analysis: &Analysis,
+    tx: &mut sqlx::Transaction<'_, sqlx::Postgres>,
+) -> Result<(), sqlx::Error> {
     log::debug!("persisting analysis for block {}", analysis.beacon_block);
 
-    let mut tx = pool.begin().await?;
     let block = &analysis.beacon_block;
     let exec = &block.body.execution_payload;
+    // values shared by all rows are converted only once
     let beacon_root_str = encode_hex_prefixed(block.root);
+    let block_hash_str = encode_hex_prefixed(exec.block_hash);
+    let slot = block.slot.as_u64() as i64;
+    let proposer_index = block.proposer_index.as_u64() as i64;
+    let block_number = exec.block_number.as_u64() as i64;
+    let proposal_time = block.proposal_time().naive_utc();
 
     sqlx::query!(
         r#"
@@ -59,105 +112,153 @@ pub async fn insert_analysis_into_db(analysis: &Analysis, pool: &Pool) -> Result
         ) ON CONFLICT DO NOTHING;
         "#,
         beacon_root_str,
-        block.slot.as_u64() as i64,
-        block.proposer_index.as_u64() as i64,
-        encode_hex_prefixed(exec.block_hash),
-        exec.block_number.as_u64() as i64,
-        block.proposal_time().naive_utc(),
+        slot,
+        proposer_index,
+        block_hash_str,
+        block_number,
+        proposal_time,
         exec.transactions.len() as i64,
         analysis.included_transactions.len() as i64,
     )
-    .execute(&mut tx)
+    .execute(&mut *tx)
     .await?;
 
+    if !analysis.missing_transactions.is_empty() {
+        insert_missing_transactions(
+            analysis,
+            tx,
+            &beacon_root_str,
+            &block_hash_str,
+            slot,
+            block_number,
+            proposer_index,
+            proposal_time,
+        )
+        .await?;
+    }
+    Ok(())
+}
+
+/// Insert all missed transactions of an analysis with a single statement. The
+/// per-transaction values are passed as arrays and unnested into the
+/// transaction, miss and full_miss tables at once. Foreign keys are checked at
+/// the end of the statement, so the misses can reference the transactions
+/// inserted alongside them.
+#[allow(clippy::too_many_arguments)]
+async fn insert_missing_transactions(
+    analysis: &Analysis,
+    tx: &mut sqlx::Transaction<'_, sqlx::Postgres>,
+    beacon_root_str: &str,
+    block_hash_str: &str,
+    slot: i64,
+    block_number: i64,
+    proposer_index: i64,
+    proposal_time: NaiveDateTime,
+) -> Result<(), sqlx::Error> {
+    let n = analysis.missing_transactions.len();
+    let mut hashes = Vec::with_capacity(n);
+    let mut senders = Vec::with_capacity(n);
+    let mut first_seens = Vec::with_capacity(n);
+    let mut quorums_reached = Vec::with_capacity(n);
+    let mut tips = Vec::with_capacity(n);
     for missing_transaction in analysis.missing_transactions.values() {
-        let transaction_hash_str = encode_hex_prefixed(missing_transaction.transaction.hash);
-        let queries = [
-            sqlx::query!(
-                r#"
+        hashes.push(encode_hex_prefixed(missing_transaction.transaction.hash));
+        senders.push(encode_hex_prefixed(missing_transaction.transaction.from));
+        first_seens.push(missing_transaction.first_seen.naive_utc());
+        quorums_reached.push(missing_transaction.quorum_reached.naive_utc());
+        tips.push(missing_transaction.tip);
+    }
+
+    sqlx::query!(
+        r#"
+        WITH missing_transaction AS (
+            SELECT
+                *
+            FROM
+                UNNEST(
+                    $1::text[],
+                    $2::text[],
+                    $3::timestamp[],
+                    $4::timestamp[],
+                    $5::bigint[]
+                ) AS t (hash, sender, first_seen, quorum_reached, tip)
+        ), inserted_transaction AS (
             INSERT INTO data.transaction (
                 hash,
                 sender,
                 first_seen,
                 quorum_reached
-            ) VALUES (
-                $1,
-                $2,
-                $3,
-                $4
-            ) ON CONFLICT DO NOTHING;
-            "#,
-                transaction_hash_str,
-                encode_hex_prefixed(missing_transaction.transaction.from),
-                missing_transaction.first_seen.naive_utc(),
-                missing_transaction.quorum_reached.naive_utc(),
-            ),
-            sqlx::query!(
-                r#"
+            ) SELECT
+                hash,
+                sender,
+                first_seen,
+                quorum_reached
+            FROM
+                missing_transaction
+            ON CONFLICT DO NOTHING
+        ), inserted_miss AS (
             INSERT INTO data.miss (
                 transaction_hash,
                 beacon_block_root,
                 proposal_time,
                 tip
-            ) VALUES (
-                $1,
-                $2,
-                $3,
-                $4
-            ) ON CONFLICT DO NOTHING;
-            "#,
-                transaction_hash_str,
-                beacon_root_str,
-                analysis.beacon_block.proposal_time().naive_utc(),
-                missing_transaction.tip,
-            ),
-            sqlx::query!(
-                r#"
-            INSERT INTO data.full_miss (
-                block_hash,
-                tx_hash,
-                slot,
-                block_number,
-                proposal_time,
-                proposer_index,
-                tx_first_seen,
-                tx_quorum_reached,
-                sender,
+            ) SELECT
+                hash,
+                $6::text,
+                $7::timestamp,
                 tip
-            ) VALUES (
-                $1,
-                $2,
-                $3,
-                $4,
-                $5,
-                $6,
-                $7,
-                $8,
-                $9,
-                $10
-            ) ON CONFLICT DO NOTHING;
-            "#,
-                encode_hex_prefixed(exec.block_hash),
-                transaction_hash_str,
-                block.slot.as_u64() as i64,
-                exec.block_number.as_u64() as i64,
-                analysis.beacon_block.proposal_time().naive_utc(),
-                analysis.beacon_block.proposer_index.as_u64() as i64,
-                missing_transaction.first_seen.naive_utc(),
-                missing_transaction.quorum_reached.naive_utc(),
-                encode_hex_prefixed(missing_transaction.transaction.from),
-                missing_transaction.tip,
-            ),
-        ];
-        for query in queries {
-            query.execute(&mut tx).await?;
-        }
-    }
-    tx.commit().await?;
-    log::debug!("persisted analysis in db");
+            FROM
+                missing_transaction
+            ON CONFLICT DO NOTHING
+        )
+        INSERT INTO data.full_miss (
+            block_hash,
+            tx_hash,
+            slot,
+            block_number,
+            proposal_time,
+            proposer_index,
+            tx_first_seen,
+            tx_quorum_reached,
+            sender,
+            tip
+        ) SELECT
+            $8::text,
+            hash,
+            $9::bigint,
+            $10::bigint,
+            $7::timestamp,
+            $11::bigint,
+            first_seen,
+            quorum_reached,
+            sender,
+            tip
+        FROM
+            missing_transaction
+        ON CONFLICT DO NOTHING;
+        "#,
+        &hashes[..],
+        &senders[..],
+        &first_seens[..],
+        &quorums_reached[..],
+        &tips[..],
+        beacon_root_str,
+        proposal_time,
+        block_hash_str,
+        slot,
+        block_number,
+        proposer_index,
+    )
+    .execute(&mut *tx)
+    .await?;
     Ok(())
 }
 
-fn encode_hex_prefixed<T: ToHex>(v: T) -> String {
-    String::from("0x") + v.encode_hex::<String>().as_str()
+/// Encode bytes as a 0x-prefixed hex string, allocating only once.
+fn encode_hex_prefixed<T: AsRef<[u8]>>(v: T) -> String {
+    let bytes = v.as_ref();
+    let mut buffer = vec![0; 2 + 2 * bytes.len()];
+    buffer[..2].copy_from_slice(b"0x");
+    hex::encode_to_slice(bytes, &mut buffer[2..]).expect("buffer has the right size");
+    String::from_utf8(buffer).expect("hex string is valid utf-8")
 }
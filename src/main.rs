@@ -14,17 +14,26 @@ mod types;
 mod watch;
 
 use core::str::FromStr;
+use std::time::Duration;
 
 use clap::Parser;
 use color_eyre::{
     eyre::{eyre, WrapErr},
     Report, Result,
 };
+use itertools::Itertools;
 use tokio::sync::{
     mpsc,
     mpsc::{Receiver, Sender},
 };
 
+/// Maximum number of analyses persisted in a single database transaction.
+const MAX_DB_BATCH_SIZE: usize = 16;
+
+/// Maximum time to wait for queued events and analyses to be processed and
+/// persisted on shutdown.
+const SHUTDOWN_TIMEOUT: Duration = Duration::from_secs(30);
+
 #[tokio::main]
 async fn main() -> Result<()> {
     color_eyre::install()?;
@@ -71,51 +80,72 @@ async fn run(config: cli::Config) -> Result<()> {
 
     let metrics_config = config.clone();
     let metrics_handle = tokio::spawn(async move {
-        log::info!("spawning metrics task");
-        metrics::serve(&metrics_config).await;
+        if metrics_config.metrics_enabled {
+            log::info!("spawning metrics task");
+            metrics::serve(&metrics_config).await;
+        } else {
+            log::warn!("metrics are disabled, metrics server will not be started");
+            futures::future::pending::<()>().await;
+        }
         Err::<(), Report>(eyre!("metrics task ended unexpectedly"))
     });
 
-    let process_handle = tokio::spawn(async move {
+    // the process and db tasks return once their input channel is closed, which
+    // on shutdown lets them finish the work that is already queued
+    let mut process_handle = tokio::spawn(async move {
         while let Some(event) = event_rx.recv().await {
             let analyses = state.process_event(event).await;
             for analysis in analyses {
-                log::info!("{}", analysis.summary());
+                log::info!("{}", analysis);
                 analysis_tx.send(analysis).await?;
             }
         }
-        Err::<(), Report>(eyre!("process task ended unexpectedly"))
+        Ok::<(), Report>(())
     });
 
-    let db_handle = tokio::spawn(async move {
+    let mut db_handle = tokio::spawn(async move {
         if !config.db_enabled {
             log::warn!("db is disabled, analyses will not be persisted");
             while analysis_rx.recv().await.is_some() {}
+            return Ok::<(), Report>(());
         }
         log::info!("spawning db task");
 
         log::debug!("connecting to db at {}", config.db_connection);
-        let pool = db::connect(config.db_connection.as_str()).await?;
+        let pool = db::connect(
+            config.db_connection.as_str(),
+            config.db_max_connections,
+            config.db_synchronous_commit,
+        )
+        .await?;
 
         db::migrate(&pool)
             .await
             .wrap_err("failed to apply db migrations")?;
 
         while let Some(analysis) = analysis_rx.recv().await {
-            db::insert_analysis_into_db(&analysis, &pool)
+            // persist the analyses that queued up in the meantime together with this one
+            let mut analyses = vec![analysis];
+            while analyses.len() < MAX_DB_BATCH_SIZE {
+                match analysis_rx.try_recv() {
+                    Ok(analysis) => analyses.push(analysis),
+                    Err(_) => break,
+                }
+            }
+            db::insert_analyses_into_db(&analyses, &pool)
                 .await
                 .wrap_err_with(|| {
                     format!(
-                        "failed to insert analysis for block {} into db",
-                        analysis.beacon_block
+                        "failed to insert analyses for blocks {} into db",
+                        analyses.iter().map(|a| &a.beacon_block).join(", ")
                     )
                 })?;
         }
 
-        Err::<(), Report>(eyre!("db task ended unexpectedly"))
+        Ok::<(), Report>(())
     });
 
-    let watch_handle = tokio::spawn(async move {
+    let mut watch_handle = tokio::spawn(async move {
         log::info!("spawning watch task");
         watch::watch(&node_config, event_tx)
             .await
@@ -124,20 +154,78 @@ async fn run(config: cli::Config) -> Result<()> {
     });
 
     tokio::select! {
-        r = metrics_handle => r,
-        r = process_handle => r,
-        r = db_handle => r,
-        r = watch_handle => r,
-    }??;
+        r = metrics_handle => return r?,
+        r = &mut process_handle => {
+            r??;
+            return Err(eyre!("process task ended unexpectedly"));
+        }
+        r = &mut db_handle => {
+            r??;
+            return Err(eyre!("db task ended unexpectedly"));
+        }
+        r = &mut watch_handle => return r?,
+        r = shutdown_signal() => r.wrap_err("failed to listen for shutdown signals")?,
+    }
+
+    // stopping the watch task drops the event sender, so the process task
+    // finishes the events that are already queued and then drops the analysis
+    // sender, after which the db task persists the remaining analyses
+    log::info!(
+        "received shutdown signal, stopping monitor (waiting up to {}s for queued analyses, \
+         signal again to exit immediately)",
+        SHUTDOWN_TIMEOUT.as_secs(),
+    );
+    watch_handle.abort();
+    let drain = async {
+        process_handle.await??;
+        db_handle.await??;
+        Ok::<(), Report>(())
+    };
+    // the drain may hang if the node or the db is unreachable, so give up after a
+    // while or if asked to terminate a second time
+    tokio::select! {
+        r = tokio::time::timeout(SHUTDOWN_TIMEOUT, drain) => {
+            r.wrap_err("timed out processing queued analyses on shutdown")??
+        }
+        r = shutdown_signal() => {
+            r.wrap_err("failed to listen for shutdown signals")?;
+            return Err(eyre!("received second shutdown signal, queued analyses are lost"));
+        }
+    }
+    log::info!("all analyses processed, shutting down");
 
     Ok(())
 }
 
+/// Wait until the process is asked to terminate, i.e., receives SIGINT or
+/// SIGTERM. On platforms other than Unix, only SIGINT is supported.
+#[cfg(unix)]
+async fn shutdown_signal() -> std::io::Result<()> {
+    use tokio::signal::unix::{signal, SignalKind};
+
+    let mut sigterm = signal(SignalKind::terminate())?;
+    tokio::select! {
+        r = tokio::signal::ctrl_c() => r,
+        _ = sigterm.recv() => Ok(()),
+    }
+}
+
+/// Wait until the process is asked to terminate, i.e., receives SIGINT or
+/// SIGTERM. On platforms other than Unix, only SIGINT is supported.
+#[cfg(not(unix))]
+async fn shutdown_signal() -> std::io::Result<()> {
+    tokio::signal::ctrl_c().await
+}
+
 async fn truncate_db(config: cli::Config) -> Result<()> {
     log::info!("drop all data from db at {}", config.db_connection);
-    let pool = db::connect(config.db_connection.as_str())
-        .await
-        .wrap_err("failed to connect to db")?;
+    let pool = db::connect(
+        config.db_connection.as_str(),
+        config.db_max_connections,
+        config.db_synchronous_commit,
+    )
+    .await
+    .wrap_err("failed to connect to db")?;
 
     db::migrate(&pool)
         .await
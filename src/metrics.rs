@@ -1,9 +1,16 @@
+use std::{sync::RwLock, time::Duration};
+
 use lazy_static::lazy_static;
 use prometheus::{
     opts, register_gauge, register_histogram_vec, register_int_counter, register_int_counter_vec,
-    register_int_gauge, Encoder, Gauge, HistogramVec, IntCounter, IntCounterVec, IntGauge,
+    register_int_gauge, Encoder, Gauge, Histogram, HistogramVec, IntCounter, IntCounterVec,
+    IntGauge,
+};
+use warp::{
+    http::{header::CONTENT_TYPE, HeaderValue},
+    hyper::body::Bytes,
+    Filter,
 };
-use warp::Filter;
 
 use crate::cli::Config;
 
@@ -96,18 +103,90 @@ lazy_static! {
     .expect("can create metric");
 }
 
+lazy_static! {
+    /// The quorum duration histogram for each quorum observed so far, indexed by
+    /// quorum minus one. They are looked up once and kept, so that observing a
+    /// duration doesn't require formatting and hashing the label every time.
+    static ref QUORUM_DURATION_HISTOGRAMS: RwLock<Vec<Histogram>> = RwLock::new(Vec::new());
+}
+
+/// Observe the time it took for a transaction to be seen by the given number of
+/// nodes.
+pub fn observe_quorum_duration(quorum: usize, duration: f64) {
+    let index = match quorum.checked_sub(1) {
+        Some(index) => index,
+        None => {
+            log::error!("ignoring quorum duration for quorum of zero nodes");
+            return;
+        }
+    };
+
+    if let Some(histogram) = QUORUM_DURATION_HISTOGRAMS
+        .read()
+        .expect("can read quorum duration histograms")
+        .get(index)
+    {
+        histogram.observe(duration);
+        return;
+    }
+
+    let mut histograms = QUORUM_DURATION_HISTOGRAMS
+        .write()
+        .expect("can write quorum duration histograms");
+    // quorums are reached one after another, so this only creates series for
+    // quorums that have already been observed, except for the new one
+    while histograms.len() <= index {
+        let label = (histograms.len() + 1).to_string();
+        histograms.push(QUORUM_DURATIONS.with_label_values(&[label.as_str()]));
+    }
+    histograms[index].observe(duration);
+}
+
 pub async fn serve(config: &Config) {
     let route = warp::path!("metrics").and_then(handler);
-    warp::serve(route).run(config.metrics_endpoint).await;
+    tokio::select! {
+        _ = refresh_response() => {},
+        _ = warp::serve(route).run(config.metrics_endpoint) => {},
+    }
 }
 
-async fn handler() -> Result<String, warp::Rejection> {
+/// Interval at which the metrics response is encoded in the background.
+const RESPONSE_REFRESH_INTERVAL: Duration = Duration::from_secs(1);
+
+lazy_static! {
+    static ref RESPONSE_BODY: RwLock<Bytes> = RwLock::new(Bytes::new());
+    static ref RESPONSE_CONTENT_TYPE: HeaderValue =
+        HeaderValue::from_static(prometheus::TEXT_FORMAT);
+}
+
+/// Periodically gather and encode the metrics, so that requests can be
+/// answered with the latest encoding without doing any work themselves.
+async fn refresh_response() {
+    let mut interval = tokio::time::interval(RESPONSE_REFRESH_INTERVAL);
+    loop {
+        interval.tick().await;
+        let body = Bytes::from(encode());
+        *RESPONSE_BODY.write().expect("can write metrics response") = body;
+    }
+}
+
+async fn handler() -> Result<impl warp::Reply, warp::Rejection> {
+    let body = RESPONSE_BODY
+        .read()
+        .expect("can read metrics response")
+        .clone();
+    let mut response = warp::reply::Response::new(body.into());
+    response
+        .headers_mut()
+        .insert(CONTENT_TYPE, RESPONSE_CONTENT_TYPE.clone());
+    Ok(response)
+}
+
+fn encode() -> Vec<u8> {
     let encoder = prometheus::TextEncoder::new();
     let mut buffer = Vec::new();
     encoder
         .encode(&prometheus::gather(), &mut buffer)
         .expect("can encode metrics");
-    let response = String::from_utf8(buffer.clone()).expect("can convert metrics to string");
-    buffer.clear();
-    Ok(response)
+    buffer
 }
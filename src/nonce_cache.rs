@@ -1,5 +1,5 @@
 use std::{
-    collections::{BTreeMap, HashMap},
+    collections::{BTreeSet, HashMap, HashSet},
     time::Instant,
 };
 
@@ -7,17 +7,29 @@ use ethers::{
     providers::{Http, Middleware, Provider, ProviderError},
     types::{BlockId, Transaction},
 };
+use futures::{StreamExt, TryStreamExt};
 use thiserror::Error;
 
 use crate::{
     metrics,
-    types::{Address, BeaconBlock, H256},
+    types::{Address, BeaconBlock, H256, U256},
 };
 
+/// The maximum number of nonce requests to have in flight at the same time when
+/// prefetching.
+const MAX_CONCURRENT_REQUESTS: usize = 16;
+
+/// A cached nonce along with the time it was last accessed.
+struct CachedNonce {
+    nonce: u64,
+    last_access_time: Instant,
+}
+
 pub struct NonceCache {
     beacon_block: BeaconBlock<Transaction>,
-    nonces: HashMap<Address, u64>,
-    last_access_time: BTreeMap<Address, Instant>,
+    nonces: HashMap<Address, CachedNonce>,
+    /// The accounts ordered by the time they were last accessed, oldest first.
+    access_order: BTreeSet<(Instant, Address)>,
     max_size: usize,
     provider: Provider<Http>,
 }
@@ -35,7 +47,7 @@ impl NonceCache {
         let c = NonceCache {
             beacon_block: BeaconBlock::default(),
             nonces: HashMap::new(),
-            last_access_time: BTreeMap::new(),
+            access_order: BTreeSet::new(),
             max_size,
             provider,
         };
@@ -48,33 +60,83 @@ impl NonceCache {
         account: &Address,
         beacon_block: &BeaconBlock<Transaction>,
     ) -> Result<u64, NonceCacheError> {
-        if beacon_block.root != self.beacon_block.root {
-            return Err(NonceCacheError::WrongBlockError {
-                internal: self.beacon_block.root,
-                queried: beacon_block.root,
-            });
+        self.check_block(beacon_block)?;
+
+        let block_id = Some(BlockId::Hash(
+            beacon_block.body.execution_payload.block_hash,
+        ));
+        let now = Instant::now();
+        if let Some(nonce) = self.touch(account, now) {
+            return Ok(nonce);
         }
 
-        self.last_access_time.insert(*account, Instant::now());
+        let nonce_u256 = self
+            .provider
+            .get_transaction_count(*account, block_id)
+            .await
+            .map_err(NonceCacheError::ProviderError)?;
+        let nonce = nonce_u256.as_u64();
+        self.insert(*account, nonce, now);
+        self.prune();
+        self.report();
+        Ok(nonce)
+    }
+
+    /// Fetch the nonces of all given accounts that are not cached yet. The
+    /// requests are sent concurrently, so that subsequent calls to get for
+    /// these accounts are served from the cache instead of waiting for one
+    /// round trip each.
+    ///
+    /// Accounts that are already cached are marked as accessed, so that the
+    /// prefetched nonces don't push them out. Only as many accounts as fit into
+    /// the cache are considered, in the given order, as otherwise prefetched
+    /// nonces would be evicted again before they are read.
+    pub async fn prefetch(
+        &mut self,
+        accounts: impl IntoIterator<Item = Address>,
+        beacon_block: &BeaconBlock<Transaction>,
+    ) -> Result<(), NonceCacheError> {
+        self.check_block(beacon_block)?;
+
+        let now = Instant::now();
+        let mut considered = HashSet::new();
+        let mut missing = Vec::new();
+        for account in accounts {
+            if considered.len() >= self.max_size {
+                break;
+            }
+            if !considered.insert(account) {
+                continue;
+            }
+            if self.touch(&account, now).is_none() {
+                missing.push(account);
+            }
+        }
+        if missing.is_empty() {
+            return Ok(());
+        }
 
         let block_id = Some(BlockId::Hash(
             beacon_block.body.execution_payload.block_hash,
         ));
-        match self.nonces.get(account) {
-            Some(&n) => Ok(n),
-            None => {
-                let nonce_u256 = self
-                    .provider
-                    .get_transaction_count(*account, block_id)
+        let provider = &self.provider;
+        let nonces: Vec<(Address, U256)> = futures::stream::iter(missing)
+            .map(move |account| async move {
+                provider
+                    .get_transaction_count(account, block_id)
                     .await
-                    .map_err(NonceCacheError::ProviderError)?;
-                let nonce = nonce_u256.as_u64();
-                self.nonces.insert(*account, nonce);
-                self.prune();
-                self.report();
-                Ok(nonce)
-            }
+                    .map(|nonce| (account, nonce))
+            })
+            .buffer_unordered(MAX_CONCURRENT_REQUESTS)
+            .try_collect()
+            .await?;
+
+        for (account, nonce) in nonces {
+            self.insert(account, nonce.as_u64(), now);
         }
+        self.prune();
+        self.report();
+        Ok(())
     }
 
     pub fn apply_block(&mut self, beacon_block: BeaconBlock<Transaction>) {
@@ -85,13 +147,14 @@ impl NonceCache {
                 beacon_block,
             );
             self.nonces.clear();
+            self.access_order.clear();
         }
         self.beacon_block = beacon_block;
 
         let mut num_modified = 0;
         for tx in &self.beacon_block.body.execution_payload.transactions {
-            self.nonces.entry(tx.from).and_modify(|n| {
-                *n = tx.nonce.as_u64() + 1;
+            self.nonces.entry(tx.from).and_modify(|cached| {
+                cached.nonce = tx.nonce.as_u64() + 1;
                 num_modified += 1;
             });
         }
@@ -104,15 +167,50 @@ impl NonceCache {
         );
     }
 
+    fn check_block(&self, beacon_block: &BeaconBlock<Transaction>) -> Result<(), NonceCacheError> {
+        if beacon_block.root != self.beacon_block.root {
+            return Err(NonceCacheError::WrongBlockError {
+                internal: self.beacon_block.root,
+                queried: beacon_block.root,
+            });
+        }
+        Ok(())
+    }
+
+    /// Mark the nonce of the given account as accessed at the given time and
+    /// return it, or return None if it is not cached.
+    fn touch(&mut self, account: &Address, time: Instant) -> Option<u64> {
+        let cached = self.nonces.get_mut(account)?;
+        // update the access time in place to get away with a single lookup
+        let previous_time = std::mem::replace(&mut cached.last_access_time, time);
+        let nonce = cached.nonce;
+        self.access_order.remove(&(previous_time, *account));
+        self.access_order.insert((time, *account));
+        Some(nonce)
+    }
+
+    /// Insert the nonce of the given account, accessed at the given time.
+    fn insert(&mut self, account: Address, nonce: u64, time: Instant) {
+        let cached = CachedNonce {
+            nonce,
+            last_access_time: time,
+        };
+        if let Some(previous) = self.nonces.insert(account, cached) {
+            self.access_order
+                .remove(&(previous.last_access_time, account));
+        }
+        self.access_order.insert((time, account));
+    }
+
     fn prune(&mut self) {
         while self.nonces.len() > self.max_size {
-            if let Some(oldest_account) = self.last_access_time.pop_first() {
-                self.nonces.remove(&oldest_account.0);
+            if let Some((_, oldest_account)) = self.access_order.pop_first() {
+                self.nonces.remove(&oldest_account);
             } else {
                 log::error!(
-                    "failed to prune nonce cache: last access time map is empty, but still too \
-                     many nonces"
+                    "failed to prune nonce cache: access order is empty, but still too many nonces"
                 );
+                break;
             }
         }
     }
@@ -121,3 +219,84 @@ impl NonceCache {
         metrics::NONCE_CACHE_SIZE.set(self.nonces.len() as i64);
     }
 }
+
+#[cfg(test)]
+mod test {
+    use std::time::Duration;
+
+    use super::*;
+
+    fn new_cache(max_size: usize) -> NonceCache {
+        // the provider is never queried, so it doesn't need to be reachable
+        let provider = Provider::<Http>::try_from("http://localhost:1").unwrap();
+        NonceCache::new(provider, max_size)
+    }
+
+    fn new_block(root: u64, parent_root: u64) -> BeaconBlock<Transaction> {
+        let mut b = BeaconBlock::default();
+        b.root = H256::from_low_u64_be(root);
+        b.parent_root = H256::from_low_u64_be(parent_root);
+        b
+    }
+
+    fn a(i: u64) -> Address {
+        Address::from_low_u64_be(i)
+    }
+
+    fn assert_accounts(c: &NonceCache, accounts: Vec<Address>) {
+        assert_eq!(c.nonces.len(), accounts.len());
+        assert_eq!(c.access_order.len(), accounts.len());
+        for account in accounts {
+            assert!(c.nonces.contains_key(&account));
+        }
+    }
+
+    #[test]
+    fn test_prune_evicts_least_recently_used() {
+        let mut c = new_cache(2);
+        let t0 = Instant::now();
+        let one_sec = Duration::from_secs(1);
+
+        c.insert(a(2), 0, t0);
+        c.insert(a(1), 0, t0 + one_sec);
+        c.insert(a(3), 0, t0 + 2 * one_sec);
+        c.prune();
+
+        // a(1) has the lowest address, but a(2) is the oldest entry
+        assert_accounts(&c, vec![a(1), a(3)]);
+    }
+
+    #[test]
+    fn test_touch_refreshes_access_time() {
+        let mut c = new_cache(2);
+        let t0 = Instant::now();
+        let one_sec = Duration::from_secs(1);
+
+        c.insert(a(1), 5, t0);
+        c.insert(a(2), 6, t0 + one_sec);
+        assert_eq!(c.touch(&a(1), t0 + 2 * one_sec), Some(5));
+        assert_eq!(c.touch(&a(3), t0 + 2 * one_sec), None);
+        c.insert(a(3), 7, t0 + 3 * one_sec);
+        c.prune();
+
+        assert_accounts(&c, vec![a(1), a(3)]);
+    }
+
+    #[test]
+    fn test_apply_block() {
+        let mut c = new_cache(10);
+        let t0 = Instant::now();
+
+        c.apply_block(new_block(1, 0));
+        c.insert(a(1), 0, t0);
+        c.insert(a(2), 0, t0);
+        assert_accounts(&c, vec![a(1), a(2)]);
+
+        c.apply_block(new_block(2, 1));
+        assert_accounts(&c, vec![a(1), a(2)]);
+
+        // reorg
+        c.apply_block(new_block(3, 1));
+        assert_accounts(&c, vec![]);
+    }
+}
@@ -13,10 +13,14 @@ use crate::{
 /// stores the timestamp at which they have first observed the transaction. In
 /// addition, it stores the timestamp at which the transactions was first
 /// observed to have disappeared from the pool on the main node.
+///
+/// The body is boxed as most transactions are only known by their hash for a
+/// while, and storing it inline would make every entry in the pool as large
+/// as a full transaction.
 #[derive(Debug, Clone)]
 pub struct ObservedTransaction {
     pub hash: TxHash,
-    pub transaction: Option<Transaction>,
+    pub transaction: Option<Box<Transaction>>,
     pub first_seen: HashMap<NodeKey, DateTime<Utc>>,
     pub disappeared: Option<DateTime<Utc>>,
 }
@@ -46,9 +50,7 @@ impl ObservedTransaction {
             let t1 = self.first_seen.values().max().unwrap();
             let dt = (*t1 - *t0).num_milliseconds() as f64 / 1000.;
             let q = self.first_seen.len();
-            metrics::QUORUM_DURATIONS
-                .with_label_values(&[q.to_string().as_str()])
-                .observe(dt);
+            metrics::observe_quorum_duration(q, dt);
         }
     }
 
@@ -74,6 +76,13 @@ impl ObservedTransaction {
             .count()
     }
 
+    /// Check if at least one node has seen the transaction at or before the
+    /// given timestamp. This stops at the first such node instead of counting
+    /// all of them.
+    pub fn has_been_seen_before(&self, timestamp: DateTime<Utc>) -> bool {
+        self.first_seen.values().any(|&t| t <= timestamp)
+    }
+
     /// Return the earliest timestamp at which a given number of nodes have seen
     /// the transaction.
     pub fn quorum_reached_timestamp(&self, quorum: usize) -> Option<DateTime<Utc>> {
@@ -104,12 +113,14 @@ impl Pool {
 
     /// Get the transactions that have been observed at least once at or before
     /// the given timestamp and have not disappeared yet.
-    pub fn content_at(&self, timestamp: DateTime<Utc>) -> HashMap<TxHash, ObservedTransaction> {
-        self.0
-            .values()
-            .filter(|tx| tx.num_nodes_seen(timestamp) >= 1 && !tx.has_disappeared_before(timestamp))
-            .map(|tx| (tx.hash, tx.clone()))
-            .collect()
+    /// The transactions are yielded lazily, without copying them.
+    pub fn content_at(
+        &self,
+        timestamp: DateTime<Utc>,
+    ) -> impl Iterator<Item = &ObservedTransaction> {
+        self.0.values().filter(move |tx| {
+            tx.has_been_seen_before(timestamp) && !tx.has_disappeared_before(timestamp)
+        })
     }
 
     /// Insert a transaction into the pool observed on the given node at the
@@ -137,27 +148,38 @@ impl Pool {
         timestamp: DateTime<Utc>,
         content: TxpoolContent,
     ) {
-        let txs: HashMap<TxHash, &Transaction> = content
+        // size the map up front to avoid rehashing it while it is filled
+        let capacity = content
             .pending
             .values()
             .chain(content.queued.values())
-            .flat_map(|m| m.values())
-            .map(|tx| (tx.hash, tx))
-            .collect();
+            .map(|m| m.len())
+            .sum();
+        let mut txs: HashMap<TxHash, Transaction> = HashMap::with_capacity(capacity);
+        txs.extend(
+            content
+                .pending
+                .into_values()
+                .chain(content.queued.into_values())
+                .flat_map(|m| m.into_values())
+                .map(|tx| (tx.hash, tx)),
+        );
         let num_txs = txs.len();
 
         // observe txs in pool
         let mut num_new = 0;
         let mut num_new_objects = 0;
         let mut num_reappeared = 0;
-        for (tx_hash, &tx) in &txs {
+        for (tx_hash, tx) in txs.iter_mut() {
             let obs_tx = self.0.entry(*tx_hash).or_insert_with(|| {
                 num_new += 1;
                 ObservedTransaction::new(*tx_hash)
             });
             if obs_tx.transaction.is_none() {
                 num_new_objects += 1;
-                obs_tx.transaction = Some(tx.clone());
+                // the snapshot is owned, so move the body out of it instead of cloning
+                // it as only the hash is needed from here on
+                obs_tx.transaction = Some(Box::new(std::mem::take(tx)));
             }
             if obs_tx.has_disappeared_before(timestamp) {
                 num_reappeared += 1;
@@ -247,10 +269,11 @@ mod test {
         TxpoolContent { pending, queued }
     }
 
-    fn assert_content(
-        c: HashMap<TxHash, ObservedTransaction>,
+    fn assert_content<'a>(
+        c: impl Iterator<Item = &'a ObservedTransaction>,
         v: Vec<(TxHash, bool, Vec<DateTime<Utc>>, Option<DateTime<Utc>>)>,
     ) {
+        let c: HashMap<TxHash, &ObservedTransaction> = c.map(|tx| (tx.hash, tx)).collect();
         assert_eq!(c.len(), v.len());
         for (h, has_body, first_seen, disappeared) in v {
             let obs_tx = c.get(&h).unwrap();
@@ -282,12 +305,15 @@ mod test {
         let mut obs_tx = ObservedTransaction::new(H1);
         assert_eq!(obs_tx.first_seen.len(), 0);
         assert_eq!(obs_tx.num_nodes_seen(t(0)), 0);
+        assert!(!obs_tx.has_been_seen_before(t(0)));
 
         obs_tx.observe(0, t(20));
         assert_eq!(obs_tx.first_seen.len(), 1);
         assert_eq!(*obs_tx.first_seen.get(&0).unwrap(), t(20));
         assert_eq!(obs_tx.num_nodes_seen(t(19)), 0);
         assert_eq!(obs_tx.num_nodes_seen(t(20)), 1);
+        assert!(!obs_tx.has_been_seen_before(t(19)));
+        assert!(obs_tx.has_been_seen_before(t(20)));
 
         obs_tx.observe(0, t(25));
         assert_eq!(obs_tx.first_seen.len(), 1);
@@ -389,13 +415,13 @@ mod test {
         p.observe_pool(0, t(10), make_pool(vec![H1, H2]));
         p.observe_pool(0, t(20), make_pool(vec![H1]));
         p.observe_pool(0, t(30), make_pool(vec![]));
-        assert_eq!(p.content_at(t(10)).len(), 2);
+        assert_eq!(p.content_at(t(10)).count(), 2);
 
         p.prune(t(19));
-        assert_eq!(p.content_at(t(10)).len(), 2);
+        assert_eq!(p.content_at(t(10)).count(), 2);
 
         p.prune(t(20));
-        assert_eq!(p.content_at(t(10)).len(), 1);
+        assert_eq!(p.content_at(t(10)).count(), 1);
         assert_content(
             p.content_at(t(10)),
             vec![(H1, true, vec![t(10)], Some(t(30)))]
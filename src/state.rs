@@ -13,12 +13,39 @@ use crate::{
 
 const PRUNE_DELAY_SECONDS: i64 = 16 * 12;
 
+/// AnalysisQueue holds the blocks that wait to be analyzed, along with the
+/// sequence numbers of their head events. A block can only be analyzed with a
+/// pool snapshot that was requested after its head event.
+#[derive(Debug, Default)]
+struct AnalysisQueue(Vec<(u64, BeaconBlock<Transaction>)>);
+
+impl AnalysisQueue {
+    /// Queue a block along with the sequence number of its head event.
+    fn push(&mut self, sequence_number: u64, beacon_block: BeaconBlock<Transaction>) {
+        self.0.push((sequence_number, beacon_block));
+    }
+
+    /// Remove and return the blocks whose head events have a sequence number up
+    /// to and including the given one, in the order they were queued. Later
+    /// blocks stay queued.
+    fn pop_until(&mut self, sequence_number: u64) -> Vec<BeaconBlock<Transaction>> {
+        let (ready, waiting) = std::mem::take(&mut self.0)
+            .into_iter()
+            .partition(|(n, _)| *n <= sequence_number);
+        self.0 = waiting;
+        ready
+            .into_iter()
+            .map(|(_, beacon_block)| beacon_block)
+            .collect()
+    }
+}
+
 pub struct State {
     pool: Pool,
     head_history: HeadHistory,
     nonce_cache: NonceCache,
 
-    analysis_queue: Vec<BeaconBlock<Transaction>>,
+    analysis_queue: AnalysisQueue,
 
     quorum: usize,
 }
@@ -37,7 +64,7 @@ impl State {
             head_history,
             nonce_cache,
 
-            analysis_queue: Vec::new(),
+            analysis_queue: AnalysisQueue::default(),
 
             quorum: node_config.execution_ws_urls.len(),
         }
@@ -56,13 +83,18 @@ impl State {
             Event::NewHead {
                 beacon_block,
                 timestamp,
-            } => self.process_new_head_event(beacon_block, timestamp).await,
+                sequence_number,
+            } => {
+                self.process_new_head_event(beacon_block, timestamp, sequence_number)
+                    .await
+            }
             Event::TxpoolContent {
                 node,
                 content,
                 timestamp,
+                requested_for,
             } => {
-                self.process_txpool_content_event(node, content, timestamp)
+                self.process_txpool_content_event(node, content, timestamp, requested_for)
                     .await
             }
         }
@@ -83,12 +115,14 @@ impl State {
         node: NodeKey,
         content: TxpoolContent,
         t: DateTime<Utc>,
+        requested_for: u64,
     ) -> Vec<Analysis> {
         self.pool.observe_pool(node, t, content);
         self.pool.prune(t - Duration::seconds(PRUNE_DELAY_SECONDS));
 
-        let beacon_blocks = self.analysis_queue.clone();
-        self.analysis_queue.clear();
+        // blocks that arrived while the pool was being fetched are left for the
+        // next snapshot which is requested after them
+        let beacon_blocks = self.analysis_queue.pop_until(requested_for);
 
         let mut analyses = Vec::new();
         for beacon_block in beacon_blocks {
@@ -104,11 +138,12 @@ impl State {
         &mut self,
         beacon_block: BeaconBlock<Transaction>,
         t: DateTime<Utc>,
+        sequence_number: u64,
     ) -> Vec<Analysis> {
         self.head_history.observe(t, beacon_block.clone());
         self.head_history
             .prune(t - Duration::seconds(PRUNE_DELAY_SECONDS));
-        self.analysis_queue.push(beacon_block);
+        self.analysis_queue.push(sequence_number, beacon_block);
         Vec::new()
     }
 
@@ -153,3 +188,55 @@ impl State {
         }
     }
 }
+
+#[cfg(test)]
+mod test {
+    use super::*;
+    use crate::types::H256;
+
+    fn make_block(i: u8) -> BeaconBlock<Transaction> {
+        BeaconBlock {
+            root: H256::repeat_byte(i),
+            ..BeaconBlock::default()
+        }
+    }
+
+    fn roots(beacon_blocks: Vec<BeaconBlock<Transaction>>) -> Vec<H256> {
+        beacon_blocks.iter().map(|b| b.root).collect()
+    }
+
+    #[test]
+    fn test_pop_until_empty() {
+        let mut q = AnalysisQueue::default();
+        assert!(q.pop_until(0).is_empty());
+    }
+
+    #[test]
+    fn test_pop_until() {
+        let mut q = AnalysisQueue::default();
+        q.push(1, make_block(1));
+        assert!(q.pop_until(0).is_empty());
+        assert_eq!(roots(q.pop_until(1)), vec![H256::repeat_byte(1)]);
+        assert!(q.pop_until(2).is_empty());
+    }
+
+    #[test]
+    fn test_heads_during_fetch() {
+        let mut q = AnalysisQueue::default();
+
+        // the pool is requested for head 1, but heads 2 and 3 arrive before the
+        // snapshot does
+        q.push(1, make_block(1));
+        q.push(2, make_block(2));
+        q.push(3, make_block(3));
+
+        assert_eq!(roots(q.pop_until(1)), vec![H256::repeat_byte(1)]);
+
+        // the next snapshot is requested for the latest head and covers both
+        assert_eq!(
+            roots(q.pop_until(3)),
+            vec![H256::repeat_byte(2), H256::repeat_byte(3)]
+        );
+        assert!(q.pop_until(3).is_empty());
+    }
+}
@@ -1,14 +1,18 @@
+use std::time::Duration;
+
 use chrono::{DateTime, Utc};
 use ethers::{
     prelude::*,
     providers::{Http, Middleware, Provider, Ws},
 };
+use serde::Deserialize;
 use thiserror::Error;
 use tokio::{
     sync::{
         mpsc,
         mpsc::{Receiver, Sender},
     },
+    task::JoinSet,
     time::Instant,
 };
 
@@ -19,6 +23,10 @@ use crate::{
     types::{url_with_path, BeaconBlock, NewBeaconHeadEvent, NodeKey, TxHash, TxpoolContent},
 };
 
+const HEAD_EVENTS_PATH: &str = "/eth/v1/events";
+const TXPOOL_CONTENT_METHOD: &str = "txpool_content";
+const TXPOOL_CONTENT_TIMEOUT: Duration = Duration::from_secs(30);
+
 /// NodeConfig stores the RPC and websocket URLs to an Ethereum node.
 #[derive(Debug, Clone)]
 pub struct NodeConfig {
@@ -45,14 +53,13 @@ impl NodeConfig {
     }
 
     /// Create and connect a websocket provider for each of the nodes at
-    /// execution_ws_urls.
+    /// execution_ws_urls. The connections are established concurrently.
     pub async fn execution_ws_providers(&self) -> Result<Vec<Provider<Ws>>, ProviderError> {
-        let mut providers = Vec::new();
-        for url in &self.execution_ws_urls {
-            let provider = Provider::connect(url).await?;
-            providers.push(provider);
-        }
-        Ok(providers)
+        let connections = self
+            .execution_ws_urls
+            .iter()
+            .map(|url| Provider::<Ws>::connect(url));
+        futures::future::try_join_all(connections).await
     }
 
     /// Create and connect a consensus node provider for the node at
@@ -100,11 +107,17 @@ pub enum Event {
     NewHead {
         beacon_block: BeaconBlock<Transaction>,
         timestamp: DateTime<Utc>,
+        /// The position of the event in the stream of head events, starting at
+        /// one.
+        sequence_number: u64,
     },
     TxpoolContent {
         node: NodeKey,
         content: TxpoolContent,
         timestamp: DateTime<Utc>,
+        /// The sequence number of the latest head event the pool was fetched
+        /// for. The content is only meaningful for heads up to this one.
+        requested_for: u64,
     },
 }
 
@@ -127,6 +140,26 @@ pub enum WatchError {
     },
     #[error("error from consensus client")]
     ConsensusAPI(#[from] ConsensusAPIError),
+    #[error("error fetching {requested}")]
+    Reqwest {
+        source: reqwest::Error,
+        requested: String,
+    },
+    #[error("JSON-RPC error {code}: {message}")]
+    JSONRPC { code: i64, message: String },
+}
+
+/// Response to a JSON-RPC request.
+#[derive(Deserialize, Debug)]
+struct JSONRPCResponse<T> {
+    result: Option<T>,
+    error: Option<JSONRPCError>,
+}
+
+#[derive(Deserialize, Debug)]
+struct JSONRPCError {
+    code: i64,
+    message: String,
 }
 
 /// Watch for relevant events. The events are sent to the given tx channel. The
@@ -137,18 +170,32 @@ pub enum WatchError {
 /// - TxpoolContent: after each new head, the tx pool content is queried and
 ///   yielded
 ///
+/// The tx pool is fetched in a separate task, so that fetching and decoding
+/// the pool doesn't hold up processing the next head. Heads that arrive while
+/// a fetch is in progress trigger another fetch once it is done.
+///
 /// Returns an error if there's an issue with the node connection or the
 /// receiving side of the channel is closed.
 pub async fn watch(node_config: &NodeConfig, tx: Sender<Event>) -> Result<(), WatchError> {
-    let transactions_handle = tokio::spawn(watch_transactions(node_config.clone(), tx.clone()));
-    let heads_handle = tokio::spawn(watch_heads(node_config.clone(), tx.clone()));
-    let r = tokio::select! {
-        r = transactions_handle => r,
-        r = heads_handle => r,
-    };
-    match r {
-        Ok(r) => r,
-        Err(e) => Err(WatchError::from(e)),
+    // the pool fetcher only needs to know the time of the latest head it should
+    // fetch the pool for, so requests made during a fetch are coalesced into one
+    let (pool_request_tx, pool_request_rx) = tokio::sync::watch::channel(0);
+
+    // dropping the set aborts the tasks in it, so that they don't keep running
+    // and holding on to the event sender once this function returns or is
+    // cancelled
+    let mut tasks = JoinSet::new();
+    tasks.spawn(watch_transactions(node_config.clone(), tx.clone()));
+    tasks.spawn(watch_heads(
+        node_config.clone(),
+        tx.clone(),
+        pool_request_tx,
+    ));
+    tasks.spawn(watch_pool(node_config.clone(), tx, pool_request_rx));
+    match tasks.join_next().await {
+        Some(Ok(r)) => r,
+        Some(Err(e)) => Err(WatchError::from(e)),
+        None => Err(WatchError::StreamEnded),
     }
 }
 
@@ -164,15 +211,15 @@ pub async fn watch_transactions(
     let mut streams_with_channels = Vec::new();
     for (i, provider) in ws_providers.iter().enumerate() {
         let stream = provider.subscribe_pending_txs().await?.map(move |v| (i, v));
-        streams_with_channels.push((stream, tx.clone(), error_tx.clone()));
+        // look up the labeled counter only once instead of for every transaction
+        let counter = metrics::TXS_FROM_PROVIDERS.with_label_values(&[i.to_string().as_str()]);
+        streams_with_channels.push((stream, counter, tx.clone(), error_tx.clone()));
     }
 
     futures::stream::iter(streams_with_channels)
-        .for_each_concurrent(None, |(mut stream, tx, error_tx)| async move {
+        .for_each_concurrent(None, |(mut stream, counter, tx, error_tx)| async move {
             while let Some((node, hash)) = stream.next().await {
-                metrics::TXS_FROM_PROVIDERS
-                    .with_label_values(&[node.to_string().as_str()])
-                    .inc();
+                counter.inc();
                 let event = Event::NewTransaction {
                     node,
                     hash,
@@ -198,14 +245,20 @@ pub async fn watch_transactions(
     Err(error_rx.recv().await.unwrap_or(WatchError::StreamEnded))
 }
 
-async fn watch_heads(node_config: NodeConfig, tx: Sender<Event>) -> Result<(), WatchError> {
-    let exec_provider = node_config.execution_http_provider();
+async fn watch_heads(
+    node_config: NodeConfig,
+    tx: Sender<Event>,
+    pool_request_tx: tokio::sync::watch::Sender<u64>,
+) -> Result<(), WatchError> {
     let cons_provider = node_config.consensus_provider();
 
-    let mut url = url_with_path(&node_config.consensus_http_url, "/eth/v1/events");
+    let mut url = url_with_path(&node_config.consensus_http_url, HEAD_EVENTS_PATH);
     url.set_query(Some("topics=head"));
     let request = reqwest::Client::new().get(url);
     let mut es = reqwest_eventsource::EventSource::new(request).unwrap();
+    // pool requests are tagged with a counter rather than a timestamp, as the
+    // wall clock may jump and reorder them relative to the heads
+    let mut sequence_number = 0;
     while let Some(event) = es.next().await {
         let t = Utc::now();
         match event {
@@ -242,10 +295,12 @@ async fn watch_heads(node_config: NodeConfig, tx: Sender<Event>) -> Result<(), W
                     log::warn!("event channel is getting full, blocks might arrive late");
                 }
 
+                sequence_number += 1;
                 if let Err(e) = tx
                     .send(Event::NewHead {
                         beacon_block,
                         timestamp: t,
+                        sequence_number,
                     })
                     .await
                 {
@@ -259,8 +314,27 @@ async fn watch_heads(node_config: NodeConfig, tx: Sender<Event>) -> Result<(), W
             }
         }
 
+        if pool_request_tx.send(sequence_number).is_err() {
+            es.close();
+            return Err(WatchError::StreamEnded);
+        }
+    }
+    Err(WatchError::StreamEnded)
+}
+
+/// Fetch the tx pool content whenever requested on the given channel and yield
+/// it as a TxpoolContent event. The event is tagged with the sequence number of
+/// the latest head that had been observed when the fetch started.
+async fn watch_pool(
+    node_config: NodeConfig,
+    tx: Sender<Event>,
+    mut pool_request_rx: tokio::sync::watch::Receiver<u64>,
+) -> Result<(), WatchError> {
+    let client = reqwest::Client::new();
+    while pool_request_rx.changed().await.is_ok() {
+        let requested_for = *pool_request_rx.borrow_and_update();
         let fetch_pool_t0 = Instant::now();
-        let content = exec_provider.txpool_content().await?;
+        let content = fetch_txpool_content(&client, &node_config.execution_http_url).await?;
         metrics::FETCH_POOL_DURATION
             .set(Instant::elapsed(&fetch_pool_t0).as_millis() as f64 / 1000.);
 
@@ -268,8 +342,71 @@ async fn watch_heads(node_config: NodeConfig, tx: Sender<Event>) -> Result<(), W
             node: 0,
             content,
             timestamp: Utc::now(),
+            requested_for,
         };
         tx.send(event).await?;
     }
     Err(WatchError::StreamEnded)
 }
+
+/// Fetch the content of the tx pool of the execution node at url.
+///
+/// The request is made directly instead of through the ethers provider, as the
+/// latter parses the response twice (first into a raw JSON value, then into the
+/// result type) which is expensive for a pool that is several megabytes in
+/// size. Here, the response body is deserialized in a single pass.
+async fn fetch_txpool_content(
+    client: &reqwest::Client,
+    url: &url::Url,
+) -> Result<TxpoolContent, WatchError> {
+    let map_reqwest_err = |e: reqwest::Error| WatchError::Reqwest {
+        source: e,
+        requested: String::from("txpool content"),
+    };
+    let body = client
+        .post(url.clone())
+        .timeout(TXPOOL_CONTENT_TIMEOUT)
+        .json(&serde_json::json!({
+            "jsonrpc": "2.0",
+            "id": 1,
+            "method": TXPOOL_CONTENT_METHOD,
+            "params": [],
+        }))
+        .send()
+        .await
+        .map_err(map_reqwest_err)?
+        .error_for_status()
+        .map_err(map_reqwest_err)?
+        .bytes()
+        .await
+        .map_err(map_reqwest_err)?;
+
+    // decoding the pool takes a while, so we do it on the blocking thread pool to
+    // not stall the other tasks
+    let response = tokio::task::spawn_blocking(move || {
+        serde_json::from_slice::<JSONRPCResponse<TxpoolContent>>(&body).map_err(|e| {
+            WatchError::JSONDecoding {
+                data: String::from_utf8_lossy(&body).into_owned(),
+                source: e,
+            }
+        })
+    })
+    .await??;
+    match response {
+        JSONRPCResponse {
+            result: Some(content),
+            ..
+        } => Ok(content),
+        JSONRPCResponse {
+            error: Some(JSONRPCError { code, message }),
+            ..
+        } => Err(WatchError::JSONRPC { code, message }),
+        JSONRPCResponse {
+            result: None,
+            error: None,
+        } => Err(WatchError::JSONRPC {
+            code: 0,
+            message: String::from("response contains neither result nor error"),
+        }),
+    }
+}